@@ -1,90 +1,410 @@
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, HttpUrl
-from typing import Optional, Dict
-from collections import defaultdict
+from pydantic import BaseModel, ConfigDict, field_validator
+from typing import Literal, Optional, Dict, List, Tuple, Union
+from collections import Counter, OrderedDict, deque
+from cachetools import Cache, LRUCache, TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from itertools import islice
+import asyncio
+import copy
+import functools
 import secrets
+import threading
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+import hashlib
+import heapq
+import math
 import yt_dlp
+from yt_dlp.postprocessor.ffmpeg import ACODECS
+from yt_dlp.utils import sanitize_filename
+from redis import asyncio as aioredis
 import os
 from pathlib import Path
 import re
+from urllib.parse import quote
+
+# --- Worker Pool ---
+# yt-dlp and ffmpeg are blocking, so they run on a bounded thread pool to keep
+# the event loop free for other requests
+
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+EXECUTOR: Optional[ThreadPoolExecutor] = None
+WORKER_SEM = asyncio.Semaphore(DOWNLOAD_WORKERS)
+
+# each ffmpeg job gets FFMPEG_THREADS threads and only enough jobs run at once
+# to fill the cores, so parallel transcodes don't slow each other down
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", "2"))
+FFMPEG_JOBS = max(1, (os.cpu_count() or 1) // FFMPEG_THREADS)
+FFMPEG_SEM = asyncio.Semaphore(FFMPEG_JOBS)
+
+# metadata and subtitle lookups take a few seconds at most, so they get their
+# own slots instead of queueing behind downloads that hold one for minutes
+INFO_WORKERS = int(os.getenv("INFO_WORKERS", "4"))
+INFO_SEM = asyncio.Semaphore(INFO_WORKERS)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global EXECUTOR
+    # room for every download, ffmpeg and info slot to be busy at once
+    EXECUTOR = ThreadPoolExecutor(
+        max_workers=DOWNLOAD_WORKERS + FFMPEG_JOBS + INFO_WORKERS, thread_name_prefix="worker"
+    )
+    asyncio.get_running_loop().set_default_executor(EXECUTOR)
+    background = [
+        asyncio.create_task(refill_id_pool()),
+        asyncio.create_task(janitor()),
+    ]
+    yield
+    for task in background:
+        task.cancel()
+    EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
+
+async def run_in_worker(func, *args):
+    # wait on the semaphore so excess requests queue here instead of on the pool
+    async with WORKER_SEM:
+        return await asyncio.get_running_loop().run_in_executor(EXECUTOR, func, *args)
+
+
+async def run_transcode(func, *args):
+    # ffmpeg jobs don't hold a download slot, so the next download can start
+    # while an earlier one is still being transcoded
+    async with FFMPEG_SEM:
+        return await asyncio.get_running_loop().run_in_executor(EXECUTOR, func, *args)
+
+
+async def run_info(func, *args):
+    async with INFO_SEM:
+        return await asyncio.get_running_loop().run_in_executor(EXECUTOR, func, *args)
+
+
+# downloads currently running, keyed by (video id, format)
+INFLIGHT: Dict[Tuple[str, str], asyncio.Task] = {}
+
+
+def finish_inflight(key: Tuple[str, str], task: asyncio.Task):
+    if INFLIGHT.get(key) is task:
+        del INFLIGHT[key]
+    if not task.cancelled():
+        task.exception()  # don't warn about an unretrieved exception when every requester left
+
+
+async def run_coalesced(key: Tuple[str, str], func, *args):
+    # concurrent requests for the same key share one download instead of each
+    # running their own. it runs as its own task, which every requester only
+    # waits on, so a requester that goes away neither cancels it for the others
+    # nor frees the key while yt-dlp is still writing the file
+    task = INFLIGHT.get(key)
+    if task is None:
+        task = INFLIGHT[key] = asyncio.ensure_future(func(*args))
+        task.add_done_callback(functools.partial(finish_inflight, key))
+    return await asyncio.shield(task)
+
 
 app = FastAPI(
     title="AudioTube API",
     description="A service to download YouTube videos as audio files in various formats",
     version="2.0.0",
+    lifespan=lifespan,
 )
 
 # Configure CORS
-origins = [
+# CORS matches exact origins (no paths or wildcards); the geeth.app subdomains
+# are covered by one compiled regex instead of a list entry each
+origins = {
     "http://localhost",
     "http://localhost:3000",
     "https://audiotube.geethg.com",
-    "https://audiotube.geeth.app",
-    "https://at.geeth.app",
-    "https://at-api.geeth.app",
-    "https://youtube.geeth.app",
-    "https://yt.geeth.app",
-]
+}
+origin_regex = r"https://(audiotube|at|at-api|youtube|yt)\.geeth\.app"
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
+    allow_origin_regex=origin_regex,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
+
 # Configure directories
-DOWNLOAD_DIR = Path("downloads")
+# absolute, like the paths yt-dlp reports, so a file always has one Path for
+# the download refcounts and UNLINKING whether it was fetched or reused
+DOWNLOAD_DIR = Path(os.path.abspath("downloads"))
 DOWNLOAD_DIR.mkdir(exist_ok=True)
-TEMP_DIR = Path("temp")
+TEMP_DIR = Path(os.path.abspath("temp"))
 TEMP_DIR.mkdir(exist_ok=True)
 
+# public address download links are built on
+BASE_URL = os.getenv("BASE_URL", "http://localhost:8000")
+
+# when set (e.g. "/internal"), /download/{id} hands files to the reverse proxy
+# through X-Accel-Redirect instead of streaming them itself; the proxy maps
+# <prefix>/downloads/ and <prefix>/temp/ onto the two directories
+ACCEL_REDIRECT_PREFIX = os.getenv("ACCEL_REDIRECT_PREFIX", "").rstrip("/")
+
+# content types for the files we hand out, by suffix, so browsers can play
+# them while they stream; the system mime.types doesn't know all of these
+MEDIA_TYPES = {
+    ".mp3": "audio/mpeg",
+    ".m4a": "audio/mp4",
+    ".wav": "audio/wav",
+    ".opus": "audio/ogg",
+    ".ogg": "audio/ogg",
+    ".mp4": "video/mp4",
+    ".srt": "application/x-subrip",
+    ".vtt": "text/vtt",
+    ".ass": "text/x-ssa",
+}
+
 # Configure temporary URL settings
 URL_EXPIRY_HOURS = 24
-TEMP_DOWNLOADS = {}
+URL_EXPIRY_SECONDS = URL_EXPIRY_HOURS * 3600
+MAX_TEMP_DOWNLOADS = 10_000
+
+
+def remove_file(filepath: Path):
+    if filepath.exists():
+        try:
+            filepath.unlink()
+        except Exception:
+            pass
+
+
+class DownloadCache(TTLCache):
+    """TTLCache of download entries that tracks which files are no longer needed.
+
+    Repeat downloads of the same video and format share one file, so files
+    are reference counted and only queued for removal once no entry refers to
+    them. The janitor task does the actual deleting, off the request path.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.file_refs: Counter = Counter()
+        self.unreferenced: set = set()
+
+    def __setitem__(self, key, entry):
+        super().__setitem__(key, entry)
+        self.file_refs[entry["filepath"]] += 1
+
+    def __delitem__(self, key):
+        # read the raw entry, since an expired one is still deleted by TTLCache
+        entry = Cache.__getitem__(self, key)
+        try:
+            super().__delitem__(key)
+        finally:
+            self.release(entry)
+
+    def expire(self, time=None):
+        # TTLCache.expire only returns the expired items from cachetools 5.5 on
+        expired = super().expire(time)
+        for _, entry in expired:
+            self.release(entry)
+        return expired
+
+    def release(self, entry: Dict):
+        filepath = entry["filepath"]
+        self.file_refs[filepath] -= 1
+        if self.file_refs[filepath] <= 0:
+            del self.file_refs[filepath]
+            self.unreferenced.add(filepath)
+
+
+# only touched from the event loop thread, so unlike the video info cache and
+# the rate limiters it needs no lock. it runs on wall-clock time so each
+# entry's expires_at is exactly when the cache drops it.
+TEMP_DOWNLOADS = DownloadCache(
+    maxsize=MAX_TEMP_DOWNLOADS, ttl=URL_EXPIRY_SECONDS, timer=time.time
+)
+JANITOR_INTERVAL_SECONDS = 60
+
+
+# files the janitor is deleting right now; a download that wants one of them
+# waits for the delete rather than handing out a file that is about to vanish
+UNLINKING: Dict[Path, asyncio.Future] = {}
+
+
+def remove_files(filepaths: List[Path]):
+    for filepath in filepaths:
+        remove_file(filepath)
+
+
+async def cleanup_expired_downloads():
+    # decide what to delete on the event loop, where the refcounts live, and
+    # leave the slow filesystem calls to a worker thread
+    TEMP_DOWNLOADS.expire()
+    # a new download may have picked a file up again since it was queued
+    filepaths = [p for p in TEMP_DOWNLOADS.unreferenced if not TEMP_DOWNLOADS.file_refs[p]]
+    TEMP_DOWNLOADS.unreferenced.clear()
+    if not filepaths:
+        return
+
+    future = asyncio.get_running_loop().run_in_executor(EXECUTOR, remove_files, filepaths)
+    for filepath in filepaths:
+        UNLINKING[filepath] = future
+    try:
+        await future
+    finally:
+        for filepath in filepaths:
+            UNLINKING.pop(filepath, None)
+
+
+async def janitor():
+    while True:
+        await asyncio.sleep(JANITOR_INTERVAL_SECONDS)
+        await cleanup_expired_downloads()
 
 
 # --- Rate Limiting ---
+# the in-memory limiter is per process, so with several uvicorn workers each
+# one counts separately; set REDIS_URL to share limits across workers
+
+REDIS_URL = os.getenv("REDIS_URL")
+# a slow redis must not stall requests, so calls give up quickly and let the
+# request through
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "0.25"))
+
 
 class RateLimiter:
+    """Per-IP token bucket: holds up to max_requests tokens and refills the
+    bucket over window_seconds, so each IP costs two floats of state."""
+
+    sweep_interval = 60
+    # rotating through addresses can't grow the dict past this; ~16k buckets
+    # is about a megabyte
+    max_ips = 16_384
+
     def __init__(self, max_requests: int = 15, window_seconds: int = 60):
         self.max_requests = max_requests
         self.window_seconds = window_seconds
-        self.requests: Dict[str, list] = defaultdict(list)
+        self.refill_rate = max_requests / window_seconds  # tokens per second
+        # ip -> (tokens, last refill), least recently used first
+        self.requests: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._last_sweep = time.time()
+        self._lock = threading.Lock()
+
+    def _sweep(self, now: float):
+        # a bucket untouched for a whole window has refilled completely, which
+        # is the same as having no entry, so drop it. buckets are in last-use
+        # order, so the stale ones are all at the front.
+        cutoff = now - self.window_seconds
+        while self.requests:
+            _, last = next(iter(self.requests.values()))
+            if last >= cutoff:
+                break
+            self.requests.popitem(last=False)
+        self._last_sweep = now
+
+    def _record(self, client_ip: str, tokens: float, now: float):
+        self.requests[client_ip] = (tokens, now)
+        self.requests.move_to_end(client_ip)
+        if len(self.requests) > self.max_ips:
+            # the evicted ip just starts over with a full bucket
+            self.requests.popitem(last=False)
+
+    def _tokens(self, client_ip: str, now: float) -> float:
+        tokens, last = self.requests.get(client_ip, (self.max_requests, now))
+        return min(self.max_requests, tokens + (now - last) * self.refill_rate)
 
     def is_allowed(self, client_ip: str) -> bool:
-        now = time.time()
-        self.requests[client_ip] = [
-            t for t in self.requests[client_ip]
-            if now - t < self.window_seconds
-        ]
-        if len(self.requests[client_ip]) >= self.max_requests:
-            return False
-        self.requests[client_ip].append(now)
-        return True
+        with self._lock:
+            now = time.time()
+            if now - self._last_sweep > self.sweep_interval:
+                self._sweep(now)
+            tokens = self._tokens(client_ip, now)
+            if tokens < 1:
+                self._record(client_ip, tokens, now)
+                return False
+            self._record(client_ip, tokens - 1, now)
+            return True
 
     def get_retry_after(self, client_ip: str) -> int:
-        if not self.requests[client_ip]:
-            return 0
-        oldest = min(self.requests[client_ip])
-        return max(0, int(self.window_seconds - (time.time() - oldest)))
+        with self._lock:
+            tokens = self._tokens(client_ip, time.time())
+        return max(0, math.ceil((1 - tokens) / self.refill_rate))
+
+    async def check(self, client_ip: str) -> Optional[int]:
+        # None when the request may go ahead, else seconds until it may retry
+        if self.is_allowed(client_ip):
+            return None
+        return self.get_retry_after(client_ip)
+
+
+class RedisRateLimiter:
+    """Same token bucket as RateLimiter, kept in redis so every worker shares it.
+
+    Uses the asyncio client so the event loop never blocks on redis, and fails
+    open: if redis errors or times out the request is allowed.
+    """
+
+    # refill and take a token atomically on the redis side; returns -1 when
+    # allowed, otherwise the seconds until the next token
+    TAKE_TOKEN = """
+    local capacity, rate, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local last = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + (now - last) * rate)
+    local retry_after = -1
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        retry_after = math.ceil((1 - tokens) / rate)
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[1], tonumber(ARGV[4]))
+    return retry_after
+    """
+
+    def __init__(self, client, name: str, max_requests: int = 15, window_seconds: int = 60):
+        self.max_requests = max_requests
+        self.window_seconds = window_seconds
+        self.refill_rate = max_requests / window_seconds  # tokens per second
+        self.client = client
+        self.prefix = f"ratelimit:{name}:"
+        self.take_token = client.register_script(self.TAKE_TOKEN)
+
+    async def check(self, client_ip: str) -> Optional[int]:
+        try:
+            retry_after = await self.take_token(
+                keys=[self.prefix + client_ip],
+                args=[self.max_requests, self.refill_rate, time.time(), self.window_seconds],
+            )
+        except (aioredis.RedisError, OSError):
+            return None
+        return None if retry_after < 0 else retry_after
+
+
+AnyRateLimiter = Union[RateLimiter, RedisRateLimiter]
+
+
+def make_rate_limiter(name: str, max_requests: int, window_seconds: int) -> AnyRateLimiter:
+    if not REDIS_URL:
+        return RateLimiter(max_requests=max_requests, window_seconds=window_seconds)
+    client = aioredis.Redis.from_url(
+        REDIS_URL, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT
+    )
+    return RedisRateLimiter(client, name, max_requests=max_requests, window_seconds=window_seconds)
 
 
-rate_limiter = RateLimiter(max_requests=15, window_seconds=60)
-info_rate_limiter = RateLimiter(max_requests=30, window_seconds=60)
+rate_limiter = make_rate_limiter("download", max_requests=15, window_seconds=60)
+info_rate_limiter = make_rate_limiter("info", max_requests=30, window_seconds=60)
 
 
-def check_rate_limit(request: Request, limiter: RateLimiter = None):
+async def check_rate_limit(request: Request, limiter: Optional[AnyRateLimiter] = None):
     if limiter is None:
         limiter = rate_limiter
     client_ip = request.client.host if request.client else "unknown"
-    if not limiter.is_allowed(client_ip):
-        retry_after = limiter.get_retry_after(client_ip)
+    retry_after = await limiter.check(client_ip)
+    if retry_after is not None:
         raise HTTPException(
             status_code=429,
             detail=f"Too many requests. Try again in {retry_after} seconds.",
@@ -95,29 +415,62 @@ def check_rate_limit(request: Request, limiter: RateLimiter = None):
 # --- Video Info Cache ---
 # caches yt-dlp info responses so /info + /download don't double-hit youtube
 
-VIDEO_INFO_CACHE: Dict[str, dict] = {}
-VIDEO_INFO_CACHE_TTL = 300  # 5 minutes
+VIDEO_INFO_CACHE_TTL = 1800  # 30 minutes
+VIDEO_INFO_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=VIDEO_INFO_CACHE_TTL)
+VIDEO_INFO_LOCK = threading.Lock()  # lookups run on worker threads
+
+# large fields nothing downstream reads
+VIDEO_INFO_DROP_KEYS = ("description", "heatmap", "chapters", "tags", "categories")
+
+
+def video_cache_key(url: str) -> str:
+    return extract_video_id(url) or url
+
+
+def slim_video_info(info: Dict) -> Dict:
+    slim = {k: v for k, v in info.items() if k not in VIDEO_INFO_DROP_KEYS}
+    # /info only lists caption languages, so drop the per-language format lists
+    slim["automatic_captions"] = {lang: [] for lang in info.get("automatic_captions") or {}}
+    return slim
+
+
+def cached_video_info(url: str) -> Optional[Dict]:
+    with VIDEO_INFO_LOCK:
+        return VIDEO_INFO_CACHE.get(video_cache_key(url))
 
 
 def get_cached_video_info(url: str) -> Dict:
-    now = time.time()
-    if url in VIDEO_INFO_CACHE:
-        entry = VIDEO_INFO_CACHE[url]
-        if now - entry["ts"] < VIDEO_INFO_CACHE_TTL:
-            return entry["data"]
-        del VIDEO_INFO_CACHE[url]
-
-    # evict stale entries if cache gets big
-    if len(VIDEO_INFO_CACHE) > 100:
-        stale = [k for k, v in VIDEO_INFO_CACHE.items() if now - v["ts"] >= VIDEO_INFO_CACHE_TTL]
-        for k in stale:
-            del VIDEO_INFO_CACHE[k]
-
-    data = get_video_info(url)
-    VIDEO_INFO_CACHE[url] = {"data": data, "ts": now}
+    data = cached_video_info(url)
+    if data is not None:
+        return data
+
+    # failures raise before anything is stored, so errors are never cached
+    data = slim_video_info(get_video_info(url))
+    with VIDEO_INFO_LOCK:
+        VIDEO_INFO_CACHE[video_cache_key(url)] = data
     return data
 
 
+async def lookup_video_info(url: str) -> Dict:
+    # cache hits are answered right here on the loop; only misses wait for
+    # an info slot and a worker thread
+    data = cached_video_info(url)
+    if data is not None:
+        return data
+    return await run_info(get_cached_video_info, url)
+
+
+def invalidate_video_info(url: str):
+    with VIDEO_INFO_LOCK:
+        VIDEO_INFO_CACHE.pop(video_cache_key(url), None)
+
+
+# Extra ffmpeg arguments, keyed by yt-dlp postprocessor name. Audio extraction
+# re-encodes, so give it its share of cores; mp4 merges only copy streams, so
+# just move the moov atom up front for progressive playback.
+AUDIO_PP_ARGS = {"extractaudio": ["-threads", str(FFMPEG_THREADS)]}
+MP4_PP_ARGS = {"merger": ["-movflags", "+faststart"]}
+
 # Available audio formats and their yt-dlp format codes
 AUDIO_FORMATS = {
     "mp3": {
@@ -129,9 +482,10 @@ AUDIO_FORMATS = {
                 "preferredquality": "192",
             }
         ],
+        "postprocessor_args": AUDIO_PP_ARGS,
     },
     "m4a": {
-        "format": "bestaudio[ext=m4a]",
+        "format": "bestaudio[ext=m4a]/bestaudio/best",
         "postprocessors": [
             {
                 "key": "FFmpegExtractAudio",
@@ -139,6 +493,7 @@ AUDIO_FORMATS = {
                 "preferredquality": "192",
             }
         ],
+        "postprocessor_args": AUDIO_PP_ARGS,
     },
     "wav": {
         "format": "bestaudio/best",
@@ -148,6 +503,7 @@ AUDIO_FORMATS = {
                 "preferredcodec": "wav",
             }
         ],
+        "postprocessor_args": AUDIO_PP_ARGS,
     },
     "opus": {
         "format": "bestaudio/best",
@@ -155,8 +511,10 @@ AUDIO_FORMATS = {
             {
                 "key": "FFmpegExtractAudio",
                 "preferredcodec": "opus",
+                "preferredquality": "128",
             }
         ],
+        "postprocessor_args": AUDIO_PP_ARGS,
     },
     "vorbis": {
         "format": "bestaudio/best",
@@ -164,17 +522,20 @@ AUDIO_FORMATS = {
             {
                 "key": "FFmpegExtractAudio",
                 "preferredcodec": "vorbis",
+                "preferredquality": "128",
             }
         ],
+        "postprocessor_args": AUDIO_PP_ARGS,
     },
     "aac": {
-        "format": "bestaudio[ext=m4a]",
+        "format": "bestaudio[ext=m4a]/bestaudio/best",
         "postprocessors": [
             {
                 "key": "FFmpegExtractAudio",
                 "preferredcodec": "aac",
             }
         ],
+        "postprocessor_args": AUDIO_PP_ARGS,
     },
 }
 
@@ -183,18 +544,22 @@ VIDEO_FORMATS = {
     "mp4": {
         "format": "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best",
         "merge_output_format": "mp4",
+        "postprocessor_args": MP4_PP_ARGS,
     },
     "best": {
         "format": "bestvideo+bestaudio/best",
         "merge_output_format": "mp4",
+        "postprocessor_args": MP4_PP_ARGS,
     },
     "medium": {
         "format": "bestvideo[height<=480]+bestaudio/best[height<=480]/best",
         "merge_output_format": "mp4",
+        "postprocessor_args": MP4_PP_ARGS,
     },
     "low": {
         "format": "bestvideo[height<=360]+bestaudio/best[height<=360]/best",
         "merge_output_format": "mp4",
+        "postprocessor_args": MP4_PP_ARGS,
     },
     "audio-only": {
         "format": "bestaudio/best",
@@ -204,26 +569,62 @@ VIDEO_FORMATS = {
                 "preferredcodec": "mp3",
             }
         ],
+        "postprocessor_args": AUDIO_PP_ARGS,
     },
 }
 
+# the format tables never change, so /formats and /video-formats hand out
+# these lists instead of rebuilding them on every page load
+AUDIO_FORMAT_NAMES = list(AUDIO_FORMATS)
+VIDEO_FORMAT_NAMES = list(VIDEO_FORMATS)
+
 
-class VideoRequest(BaseModel):
-    url: HttpUrl
-    format: str = "mp3"
+# matches every supported youtube url shape and captures the 11-character video id
+YT_RE = re.compile(
+    r"(?:youtu\.be/|youtube-nocookie\.com/embed/"
+    r"|youtube\.com/(?:shorts/|live/|v/|embed/|watch\?(?:[^#]*&)?v=))"
+    r"(?P<id>[a-zA-Z0-9_-]{11})(?![a-zA-Z0-9_-])"
+)
 
 
-class VideoDownloadRequest(BaseModel):
-    url: str
-    format: str = "mp4"
+def extract_video_id(url: str) -> Optional[str]:
+    match = YT_RE.search(url)
+    return match["id"] if match else None
 
 
-class VideoInfoRequest(BaseModel):
-    url: str
+# unknown formats and non-youtube urls are rejected while parsing the request,
+# before any work is done
+AudioFormat = Literal[tuple(AUDIO_FORMAT_NAMES)]
+VideoFormat = Literal[tuple(VIDEO_FORMAT_NAMES)]
+
 
+class YouTubeRequest(BaseModel):
+    model_config = ConfigDict(extra="forbid", str_strip_whitespace=True)
 
-class SubtitleRequest(BaseModel):
     url: str
+
+    @field_validator("url")
+    @classmethod
+    def normalize_youtube_url(cls, url: str) -> str:
+        video_id = extract_video_id(url)
+        if video_id is None:
+            raise ValueError("not a recognized YouTube URL")
+        return f"https://www.youtube.com/watch?v={video_id}"
+
+
+class VideoRequest(YouTubeRequest):
+    format: AudioFormat = "mp3"
+
+
+class VideoDownloadRequest(YouTubeRequest):
+    format: VideoFormat = "mp4"
+
+
+class VideoInfoRequest(YouTubeRequest):
+    pass
+
+
+class SubtitleRequest(YouTubeRequest):
     lang: str = "en"
 
 
@@ -237,229 +638,350 @@ class DownloadResponse(BaseModel):
     expires_at: datetime
 
 
+# response models let FastAPI serialize straight to JSON bytes with pydantic-core
+
+class SubtitleResponse(BaseModel):
+    download_id: str
+    title: str
+    language: str
+    download_url: str
+    expires_at: datetime
+
+
+class FormatsResponse(BaseModel):
+    formats: List[str]
+    default: str
+
+
+class DownloadFile(BaseModel):
+    filename: str
+    size: int
+    created: float
+
+
+class DownloadsResponse(BaseModel):
+    downloads: List[DownloadFile]
+
+
+class HealthResponse(BaseModel):
+    status: str
+    version: str
+
+
+# --- yt-dlp Instances ---
+# building a YoutubeDL loads extractors and compiles format selectors, so each
+# worker thread keeps one instance per option set instead of one per request.
+# instances are not thread safe, which is why they aren't shared across threads.
+
+YDL_LOCAL = threading.local()
+
+
+class LockedLRUCache(LRUCache):
+    """LRUCache that can be shared between worker threads."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.RLock()  # eviction deletes from inside __setitem__
+
+    def __getitem__(self, key):
+        with self._lock:
+            return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+
+    def __missing__(self, key):
+        # yt-dlp checks `key in cache` and then reads cache[key], and another
+        # thread can evict the key in between; report that as a miss
+        return None
+
+
+# the youtube extractor downloads the player JS and solves its signature
+# challenges once per instance; sharing its caches means a player fetched on
+# one thread is reused by every other instance. player JS is a few megabytes
+# per version and solved challenges pile up per video, so both are capped.
+YT_CODE_CACHE = LockedLRUCache(maxsize=8)
+YT_PLAYER_CACHE = LockedLRUCache(maxsize=4096)
+
+
+def share_player_cache(ydl: yt_dlp.YoutubeDL) -> yt_dlp.YoutubeDL:
+    ie = ydl.get_info_extractor("Youtube")
+    ie._code_cache = YT_CODE_CACHE
+    ie._player_cache = YT_PLAYER_CACHE
+    return ydl
+
+
+def get_ydl(key: tuple, opts: Dict) -> yt_dlp.YoutubeDL:
+    pool = getattr(YDL_LOCAL, "pool", None)
+    if pool is None:
+        pool = YDL_LOCAL.pool = {}
+    ydl = pool.get(key)
+    if ydl is None:
+        ydl = pool[key] = share_player_cache(yt_dlp.YoutubeDL(copy.deepcopy(opts)))
+    return ydl
+
+
 def get_video_info(url: str) -> Dict:
-    ydl_opts = {"quiet": True}
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        try:
-            return ydl.extract_info(url, download=False)
-        except Exception as e:
-            raise HTTPException(
-                status_code=400, detail=f"Error extracting video info: {str(e)}"
-            )
+    ydl = get_ydl(("info",), {"quiet": True})
+    try:
+        return ydl.extract_info(url, download=False)
+    except Exception as e:
+        raise HTTPException(
+            status_code=400, detail=f"Error extracting video info: {str(e)}"
+        )
 
 
-def generate_download_id() -> str:
-    return secrets.token_urlsafe(16)
+def extract_and_download(ydl: yt_dlp.YoutubeDL, url: str, info: Optional[Dict] = None) -> Dict:
+    # reuse already extracted info so the download doesn't hit youtube for metadata again
+    if info is None:
+        return ydl.extract_info(url, download=True)
+    return ydl.process_ie_result(ydl.sanitize_info(info, remove_private_keys=True), download=True)
 
 
-def cleanup_expired_downloads():
-    current_time = datetime.now()
-    expired_keys = [
-        k for k, v in TEMP_DOWNLOADS.items() if v["expires_at"] < current_time
-    ]
-    for k in expired_keys:
-        filepath = TEMP_DOWNLOADS[k].get("filepath")
-        if filepath and filepath.exists():
-            try:
-                filepath.unlink()
-            except Exception:
-                pass
-        TEMP_DOWNLOADS.pop(k)
+# download ids are pre-generated in the background so the request path
+# doesn't pay for os.urandom
+ID_POOL: deque = deque(maxlen=1024)
+ID_POOL_LOW_WATER = 256
+
+
+async def refill_id_pool():
+    while True:
+        if len(ID_POOL) < ID_POOL_LOW_WATER:
+            ID_POOL.extend(
+                secrets.token_urlsafe(16) for _ in range(ID_POOL.maxlen - len(ID_POOL))
+            )
+        await asyncio.sleep(1)
+
+
+def generate_download_id() -> str:
+    try:
+        return ID_POOL.popleft()
+    except IndexError:
+        return secrets.token_urlsafe(16)
 
 
 def format_duration(seconds: float) -> str:
     if not seconds:
         return "Unknown"
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    secs = int(seconds % 60)
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
     if hours > 0:
         return f"{hours}:{minutes:02d}:{secs:02d}"
     return f"{minutes}:{secs:02d}"
 
 
+# (divisor, format) per unit; sizes below 1 KB still show as KB and anything
+# past GB stays in GB
+FILESIZE_UNITS = ((1 << 10, "{:.1f} KB"), (1 << 20, "{:.1f} MB"), (1 << 30, "{:.2f} GB"))
+
+
 def format_filesize(size_bytes) -> str:
     if not size_bytes:
         return None
-    if size_bytes < 1024 * 1024:
-        return f"{size_bytes / 1024:.1f} KB"
-    if size_bytes < 1024 * 1024 * 1024:
-        return f"{size_bytes / (1024 * 1024):.1f} MB"
-    return f"{size_bytes / (1024 * 1024 * 1024):.2f} GB"
+    # every 10 bits of the size is one unit up, so the unit comes straight
+    # from the bit length instead of a chain of comparisons
+    unit = min(2, max(0, (int(size_bytes).bit_length() - 1) // 10 - 1))
+    divisor, fmt = FILESIZE_UNITS[unit]
+    return fmt.format(size_bytes / divisor)
 
 
-def download_audio(
-    url: str, format: str = "mp3", base_url: str = None
-) -> DownloadResponse:
-    if format not in AUDIO_FORMATS:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Unsupported format. Available formats: {', '.join(AUDIO_FORMATS.keys())}",
-        )
+def output_path(video_id: str, format: str, format_opts: Dict) -> Path:
+    # where yt-dlp will leave the finished file, e.g. <DOWNLOAD_DIR>/<video id>-mp3.mp3
+    ext = format_opts.get("merge_output_format", "mp4")
+    for pp in format_opts.get("postprocessors", []):
+        if pp["key"] == "FFmpegExtractAudio":
+            ext = ACODECS[pp["preferredcodec"]][0]
+    return DOWNLOAD_DIR / f"{video_id}-{format}.{ext}"
+
 
+def register_download(filepath: Path, format: str, info: Dict) -> DownloadResponse:
     download_id = generate_download_id()
+    # kept as a unix timestamp; it only becomes a datetime in the response
+    expires_at = time.time() + URL_EXPIRY_SECONDS
+    TEMP_DOWNLOADS[download_id] = {
+        "filepath": filepath,
+        # files are named by video id on disk, so hand them out under the title
+        "filename": sanitize_filename(info.get("title") or info["id"]) + filepath.suffix,
+        "expires_at": expires_at,
+    }
+
+    return DownloadResponse(
+        download_id=download_id,
+        format=format,
+        title=info.get("title", ""),
+        duration=info.get("duration"),
+        status="completed",
+        download_url=f"{BASE_URL}/download/{download_id}",
+        expires_at=datetime.fromtimestamp(expires_at),
+    )
 
+
+def fetch_source(url: str, format: str, format_opts: Dict, info: Optional[Dict] = None) -> Dict:
+    # download stage: fetch (and for video, stream-copy merge) without running
+    # any ffmpeg extraction, which transcode() does separately
     ydl_opts = {
-        **AUDIO_FORMATS[format],
-        "outtmpl": "%(title)s-audio.%(ext)s",
+        **{k: v for k, v in format_opts.items() if k != "postprocessors"},
+        "outtmpl": str(DOWNLOAD_DIR / f"%(id)s-{format}.%(ext)s"),
+        "overwrites": False,
+        "continuedl": True,
+        # DASH/HLS streams come in fragments, fetch several at once
+        "concurrent_fragment_downloads": 4,
         "quiet": True,
     }
 
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            filename = ydl.prepare_filename(info)
-            filepath = Path(filename).with_suffix(f".{format}")
+    ydl = get_ydl(("media", format), ydl_opts)
+    return extract_and_download(ydl, url, info)
 
-            expires_at = datetime.now() + timedelta(hours=URL_EXPIRY_HOURS)
-            TEMP_DOWNLOADS[download_id] = {
-                "filepath": filepath,
-                "expires_at": expires_at,
-            }
 
-            cleanup_expired_downloads()
+def transcode(format: str, format_opts: Dict, info: Dict) -> Dict:
+    # transcode stage: run the format's postprocessors on the downloaded file,
+    # which replaces it with the converted one.
+    # yt-dlp strips every key that matches the top-level info out of
+    # requested_downloads, so merge them back into a full info dict, and drop
+    # the fixups the download stage already ran.
+    downloaded = {**info, **info["requested_downloads"][0]}
+    downloaded.pop("__postprocessors", None)
+    ydl = get_ydl(("transcode", format), {**format_opts, "quiet": True})
+    try:
+        return ydl.post_process(downloaded["filepath"], downloaded)
+    except BaseException:
+        # ffmpeg writes straight to the final name and yt-dlp leaves whatever
+        # it wrote behind, so drop the partial output and the source with it
+        remove_file(output_path(info["id"], format, format_opts))
+        remove_file(Path(downloaded["filepath"]))
+        raise
 
-            return DownloadResponse(
-                download_id=download_id,
-                format=format,
-                title=info.get("title", ""),
-                duration=info.get("duration"),
-                status="completed",
-                download_url=f"{base_url}/download/{download_id}",
-                expires_at=expires_at,
-            )
+
+async def fetch_media(
+    url: str, format: str, format_opts: Dict, info: Optional[Dict] = None
+) -> Tuple[Path, Dict]:
+    if info is not None:
+        filepath = output_path(info["id"], format, format_opts)
+        # a file a live download still refers to was finished by a successful
+        # fetch, so it can be handed out again as is. merely existing on disk
+        # isn't enough: a transcode killed midway leaves a truncated file there.
+        if TEMP_DOWNLOADS.file_refs[filepath]:
+            return filepath, info
+        unlinking = UNLINKING.get(filepath)
+        if unlinking is not None:
+            await asyncio.shield(unlinking)
+
+    info = await run_in_worker(fetch_source, url, format, format_opts, info)
+    downloaded = info["requested_downloads"][0]
+    if format_opts.get("postprocessors"):
+        downloaded = await run_transcode(transcode, format, format_opts, info)
+    # yt-dlp reports where the file really ended up; output_path is only the
+    # prediction used to find files that are already on disk
+    return Path(os.path.abspath(downloaded["filepath"])), info
+
+
+async def download_audio(
+    url: str, format: str = "mp3", info: Optional[Dict] = None
+) -> Tuple[Path, Dict]:
+    try:
+        return await fetch_media(url, format, AUDIO_FORMATS[format], info)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Download failed: {str(e)}")
 
 
-def download_video(
-    url: str, format: str = "mp4", base_url: str = None
-) -> DownloadResponse:
-    if format not in VIDEO_FORMATS:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Unsupported format. Available formats: {', '.join(VIDEO_FORMATS.keys())}",
-        )
+async def download_video(
+    url: str, format: str = "mp4", info: Optional[Dict] = None
+) -> Tuple[Path, Dict]:
+    # every format spec ends in a /best fallback, so yt-dlp picks a working
+    # format itself and there is only ever one download attempt
+    try:
+        return await fetch_media(url, format, VIDEO_FORMATS[format], info)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Download failed: {str(e)}")
 
-    download_id = generate_download_id()
 
-    with yt_dlp.YoutubeDL({"quiet": True}) as ydl:
-        info = ydl.extract_info(url, download=False)
+def download_subtitle(url: str, lang: str, download_id: str) -> Tuple[Path, Dict]:
+    ydl_opts = {
+        "writesubtitles": True,
+        "writeautomaticsub": True,
+        "subtitleslangs": [lang],
+        "subtitlesformat": "srt",
+        "skip_download": True,
+        "outtmpl": str(TEMP_DIR / f"{download_id}.%(ext)s"),
+        "quiet": True,
+    }
 
     try:
-        ydl_opts = {
-            **VIDEO_FORMATS[format],
-            "outtmpl": "%(title)s-video.%(ext)s",
-            "quiet": True,
-        }
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with share_player_cache(yt_dlp.YoutubeDL(ydl_opts)) as ydl:
             info = ydl.extract_info(url, download=True)
-            filename = ydl.prepare_filename(info)
-            ext = VIDEO_FORMATS[format].get("merge_output_format", "mp4")
-            filepath = Path(filename).with_suffix(f".{ext}")
-
-            expires_at = datetime.now() + timedelta(hours=URL_EXPIRY_HOURS)
-            TEMP_DOWNLOADS[download_id] = {
-                "filepath": filepath,
-                "expires_at": expires_at,
-            }
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Subtitle download failed: {str(e)}")
 
-            cleanup_expired_downloads()
+    # look for the subtitle file
+    for ext in ["srt", "vtt", "ass"]:
+        candidate = TEMP_DIR / f"{download_id}.{lang}.{ext}"
+        if candidate.exists():
+            return candidate, info
 
-            return DownloadResponse(
-                download_id=download_id,
-                format=format,
-                title=info.get("title", ""),
-                duration=info.get("duration"),
-                status="completed",
-                download_url=f"{base_url}/download/{download_id}",
-                expires_at=expires_at,
-            )
-    except Exception as primary_error:
-        try:
-            fallback_opts = {
-                "format": "bestvideo+bestaudio/best",
-                "merge_output_format": "mp4",
-                "outtmpl": "%(title)s-video-fallback.%(ext)s",
-                "quiet": True,
-            }
+    raise HTTPException(status_code=404, detail=f"No subtitles found for language: {lang}")
 
-            with yt_dlp.YoutubeDL(fallback_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                filename = ydl.prepare_filename(info)
-                filepath = Path(filename).with_suffix(".mp4")
 
-                expires_at = datetime.now() + timedelta(hours=URL_EXPIRY_HOURS)
-                TEMP_DOWNLOADS[download_id] = {
-                    "filepath": filepath,
-                    "expires_at": expires_at,
-                }
+class DownloadFileResponse(FileResponse):
+    # starlette reads 64 KiB at a time; bigger reads mean far fewer syscalls
+    # for files that are often hundreds of megabytes
+    chunk_size = 1 << 20
 
-                cleanup_expired_downloads()
-
-                return DownloadResponse(
-                    download_id=download_id,
-                    format="mp4",
-                    title=info.get("title", "") + " (Fallback format used)",
-                    duration=info.get("duration"),
-                    status="completed",
-                    download_url=f"{base_url}/download/{download_id}",
-                    expires_at=expires_at,
-                )
-        except Exception as fallback_error:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Download failed: {str(primary_error)}. Fallback also failed: {str(fallback_error)}",
-            )
 
+def content_disposition(filename: str) -> str:
+    # same encoding FileResponse uses for non-ascii names
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
 
-def normalize_youtube_url(url: str) -> str:
-    youtu_be_pattern = r"youtu\.be/([a-zA-Z0-9_-]+)"
-    match = re.search(youtu_be_pattern, url)
-    if match:
-        video_id = match.group(1)
-        return f"https://www.youtube.com/watch?v={video_id}"
 
-    shorts_pattern = r"youtube\.com/shorts/([a-zA-Z0-9_-]+)"
-    match = re.search(shorts_pattern, url)
-    if match:
-        video_id = match.group(1)
-        return f"https://www.youtube.com/watch?v={video_id}"
+def accel_redirect_path(filepath: Path) -> str:
+    root = DOWNLOAD_DIR if filepath.is_relative_to(DOWNLOAD_DIR) else TEMP_DIR
+    return f"{ACCEL_REDIRECT_PREFIX}/{root.name}/{filepath.relative_to(root).as_posix()}"
 
-    v_pattern = r"youtube\.com/v/([a-zA-Z0-9_-]+)"
-    match = re.search(v_pattern, url)
-    if match:
-        video_id = match.group(1)
-        return f"https://www.youtube.com/watch?v={video_id}"
 
-    embed_pattern = r"youtube\.com/embed/([a-zA-Z0-9_-]+)"
-    match = re.search(embed_pattern, url)
-    if match:
-        video_id = match.group(1)
-        return f"https://www.youtube.com/watch?v={video_id}"
+def is_not_modified(request: Request, etag: str, mtime: Optional[float] = None) -> bool:
+    # If-None-Match wins over If-Modified-Since, as in RFC 9110
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        return "*" in tags or etag in tags
 
-    return url
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or mtime is None:
+        return False
+    try:
+        return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
 
 
 # --- Endpoints ---
 
 
-@app.get("/formats")
+@app.get("/formats", response_model=FormatsResponse)
 async def list_formats():
-    return {"formats": list(AUDIO_FORMATS.keys()), "default": "mp3"}
+    return {"formats": AUDIO_FORMAT_NAMES, "default": "mp3"}
 
 
-@app.get("/video-formats")
+@app.get("/video-formats", response_model=FormatsResponse)
 async def list_video_formats():
-    return {"formats": list(VIDEO_FORMATS.keys()), "default": "mp4"}
+    return {"formats": VIDEO_FORMAT_NAMES, "default": "mp4"}
+
+
+INFO_MAX_FORMATS = 10
 
 
 @app.post("/info")
 async def video_info(request: VideoInfoRequest, req: Request):
-    check_rate_limit(req, info_rate_limiter)
-    normalized_url = normalize_youtube_url(request.url)
-    info = get_cached_video_info(normalized_url)
+    await check_rate_limit(req, info_rate_limiter)
+    normalized_url = request.url
+    info = await lookup_video_info(normalized_url)
 
     # build available format list with resolution details
     available_formats = []
@@ -484,7 +1006,11 @@ async def video_info(request: VideoInfoRequest, req: Request):
                     "has_audio": acodec != "none",
                 })
 
-    available_formats.sort(key=lambda x: x.get("height", 0), reverse=True)
+    # the client only shows the top few resolutions, so keep the best ones
+    # without sorting the whole list
+    available_formats = heapq.nlargest(
+        INFO_MAX_FORMATS, available_formats, key=lambda x: x["height"]
+    )
 
     # estimate sizes for audio formats
     duration = info.get("duration", 0)
@@ -518,138 +1044,164 @@ async def video_info(request: VideoInfoRequest, req: Request):
     }
 
 
-@app.post("/download-subtitle")
+@app.post("/download-subtitle", response_model=SubtitleResponse)
 async def download_subtitle_endpoint(request: SubtitleRequest, req: Request):
-    check_rate_limit(req)
-    normalized_url = normalize_youtube_url(request.url)
+    await check_rate_limit(req)
+    normalized_url = request.url
     download_id = generate_download_id()
-    base_url = os.getenv("BASE_URL", "http://localhost:8000")
-
-    ydl_opts = {
-        "writesubtitles": True,
-        "writeautomaticsub": True,
-        "subtitleslangs": [request.lang],
-        "subtitlesformat": "srt",
-        "skip_download": True,
-        "outtmpl": str(TEMP_DIR / f"{download_id}.%(ext)s"),
-        "quiet": True,
-    }
-
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(normalized_url, download=True)
-
-        # look for the subtitle file
-        sub_path = None
-        for ext in ["srt", "vtt", "ass"]:
-            candidate = TEMP_DIR / f"{download_id}.{request.lang}.{ext}"
-            if candidate.exists():
-                sub_path = candidate
-                break
 
-        if not sub_path:
-            raise HTTPException(status_code=404, detail=f"No subtitles found for language: {request.lang}")
+    sub_path, info = await run_info(
+        download_subtitle, normalized_url, request.lang, download_id
+    )
 
-        expires_at = datetime.now() + timedelta(hours=URL_EXPIRY_HOURS)
-        TEMP_DOWNLOADS[download_id] = {
-            "filepath": sub_path,
-            "expires_at": expires_at,
-        }
+    expires_at = time.time() + URL_EXPIRY_SECONDS
+    TEMP_DOWNLOADS[download_id] = {
+        "filepath": sub_path,
+        "expires_at": expires_at,
+    }
 
-        return {
-            "download_id": download_id,
-            "title": info.get("title", ""),
-            "language": request.lang,
-            "download_url": f"{base_url}/download/{download_id}",
-            "expires_at": expires_at.isoformat(),
-        }
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Subtitle download failed: {str(e)}")
+    return {
+        "download_id": download_id,
+        "title": info.get("title", ""),
+        "language": request.lang,
+        "download_url": f"{BASE_URL}/download/{download_id}",
+        "expires_at": datetime.fromtimestamp(expires_at),
+    }
 
 
 @app.post("/download-thumbnail")
 async def download_thumbnail_endpoint(request: VideoInfoRequest, req: Request):
-    check_rate_limit(req, info_rate_limiter)
-    normalized_url = normalize_youtube_url(request.url)
-    info = get_cached_video_info(normalized_url)
-
-    thumbnails = info.get("thumbnails", [])
-    # get highest quality thumbnail
-    best_thumb = None
-    if thumbnails:
-        best_thumb = max(thumbnails, key=lambda t: t.get("width", 0) * t.get("height", 0))
-
-    thumbnail_url = best_thumb.get("url") if best_thumb else info.get("thumbnail", "")
+    await check_rate_limit(req, info_rate_limiter)
+    normalized_url = request.url
+    info = await lookup_video_info(normalized_url)
+
+    # the five largest thumbnails, best first, in one pass
+    top_thumbs = heapq.nlargest(
+        5,
+        (t for t in info.get("thumbnails", []) if t.get("url") and t.get("width")),
+        key=lambda t: t["width"] * (t.get("height") or 0),
+    )
+    thumbnail_url = top_thumbs[0]["url"] if top_thumbs else info.get("thumbnail", "")
 
     return {
         "title": info.get("title", ""),
         "thumbnail_url": thumbnail_url,
         "thumbnails": [
-            {"url": t.get("url"), "width": t.get("width"), "height": t.get("height")}
-            for t in thumbnails
-            if t.get("url") and t.get("width")
-        ][-5:],
+            {"url": t["url"], "width": t["width"], "height": t.get("height")}
+            for t in top_thumbs
+        ],
     }
 
 
 @app.post("/download", response_model=DownloadResponse)
 async def download_video_audio(video: VideoRequest, request: Request):
-    check_rate_limit(request)
-    normalized_url = normalize_youtube_url(str(video.url))
-    get_cached_video_info(normalized_url)
-    base_url = os.getenv("BASE_URL", "http://localhost:8000")
-    return download_audio(normalized_url, video.format, base_url)
+    await check_rate_limit(request)
+    normalized_url = video.url
+    info = await lookup_video_info(normalized_url)
+    try:
+        filepath, info = await run_coalesced(
+            (info["id"], video.format), download_audio, normalized_url, video.format, info
+        )
+    except HTTPException:
+        # cached stream urls may have gone stale, so re-extract next time
+        invalidate_video_info(normalized_url)
+        raise
+    return register_download(filepath, video.format, info)
 
 
 @app.post("/download-video", response_model=DownloadResponse)
 async def download_video_endpoint(request: VideoDownloadRequest, req: Request):
-    check_rate_limit(req)
-    normalized_url = normalize_youtube_url(str(request.url))
-    get_cached_video_info(normalized_url)
-    base_url = os.getenv("BASE_URL", "http://localhost:8000")
-    return download_video(normalized_url, request.format, base_url)
+    await check_rate_limit(req)
+    normalized_url = request.url
+    info = await lookup_video_info(normalized_url)
+    try:
+        filepath, info = await run_coalesced(
+            (info["id"], request.format), download_video, normalized_url, request.format, info
+        )
+    except HTTPException:
+        invalidate_video_info(normalized_url)
+        raise
+    return register_download(filepath, request.format, info)
 
 
 @app.get("/download/{download_id}")
-async def get_download(download_id: str):
-    cleanup_expired_downloads()
-
-    if download_id not in TEMP_DOWNLOADS:
+async def get_download(download_id: str, request: Request):
+    try:
+        download_info = TEMP_DOWNLOADS[download_id]
+    except KeyError:
         raise HTTPException(status_code=404, detail="Download not found or expired")
 
-    download_info = TEMP_DOWNLOADS[download_id]
-    if download_info["expires_at"] < datetime.now():
-        TEMP_DOWNLOADS.pop(download_id)
-        raise HTTPException(status_code=404, detail="Download link expired")
-
     filepath = download_info["filepath"]
-    if not filepath.exists():
-        TEMP_DOWNLOADS.pop(download_id)
+    try:
+        stat_result = os.stat(filepath)
+    except FileNotFoundError:
+        TEMP_DOWNLOADS.pop(download_id, None)
         raise HTTPException(status_code=404, detail="File not found")
 
-    return FileResponse(
-        path=filepath, filename=filepath.name, media_type="application/octet-stream"
+    etag = f'"{stat_result.st_size:x}-{int(stat_result.st_mtime):x}"'
+    if is_not_modified(request, etag, stat_result.st_mtime):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    filename = download_info.get("filename", filepath.name)
+    media_type = MEDIA_TYPES.get(filepath.suffix, "application/octet-stream")
+    if ACCEL_REDIRECT_PREFIX:
+        # the proxy sends the file with sendfile and handles ranges itself
+        return Response(
+            media_type=media_type,
+            headers={
+                "ETag": etag,
+                "Content-Disposition": content_disposition(filename),
+                "X-Accel-Redirect": accel_redirect_path(filepath),
+            },
+        )
+
+    # passing stat_result lets FileResponse set content-length and serve range
+    # requests without its own stat call
+    return DownloadFileResponse(
+        path=filepath,
+        filename=filename,
+        media_type=media_type,
+        stat_result=stat_result,
+        headers={"ETag": etag},
     )
 
 
-@app.get("/downloads")
-async def list_downloads():
-    files = []
-    for file in DOWNLOAD_DIR.glob("*"):
-        if file.is_file():
-            files.append(
+# a plain def, so FastAPI runs the directory walk in its threadpool instead of
+# blocking the event loop on a large downloads directory
+@app.get("/downloads", response_model=DownloadsResponse)
+def list_downloads(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1),
+    offset: int = Query(0, ge=0),
+):
+    stop = offset + limit if limit is not None else None
+    page = []
+    digest = hashlib.md5(usedforsecurity=False)
+    # scandir entries carry the file type from the directory read, so only
+    # the files we return need a stat call
+    with os.scandir(DOWNLOAD_DIR) as entries:
+        files = (e for e in entries if e.is_file())
+        for entry in islice(files, offset, stop):
+            stat = entry.stat()
+            digest.update(f"{entry.name}/{stat.st_size}/{stat.st_mtime}/".encode())
+            page.append(
                 {
-                    "filename": file.name,
-                    "size": file.stat().st_size,
-                    "created": file.stat().st_ctime,
+                    "filename": entry.name,
+                    "size": stat.st_size,
+                    "created": stat.st_ctime,
                 }
             )
-    return {"downloads": files}
+
+    # pollers that already have this listing get an empty 304
+    etag = f'"{digest.hexdigest()}"'
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return {"downloads": page}
 
 
-@app.get("/health")
+@app.get("/health", response_model=HealthResponse)
 async def health_check():
     return {"status": "ok", "version": "2.0.0"}
 
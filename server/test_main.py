@@ -0,0 +1,188 @@
+import asyncio
+import functools
+import http.server
+import importlib
+import os
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+from yt_dlp.postprocessor import FFmpegExtractAudioPP
+from yt_dlp.utils import PostProcessingError
+
+import main
+
+
+@pytest.fixture
+def media_server(tmp_path):
+    # serves a fake opus stream, so downloads run without touching youtube
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "audio.webm").write_bytes(b"\x1a\x45\xdf\xa3" + b"\0" * 4096)
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=src)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+@pytest.fixture
+def download_dir(tmp_path, monkeypatch):
+    # re-import main inside a scratch directory, so downloads/ and temp/ are
+    # set up exactly as they are when the server starts there
+    monkeypatch.chdir(tmp_path)
+    importlib.reload(main)
+    return main.DOWNLOAD_DIR
+
+
+def stub_info(media_url):
+    # the top level carries the same ext/acodec as the audio format, like a
+    # cached /info result for a vp9+opus video does
+    return {
+        "id": "abcdefghijk",
+        "title": "Test",
+        "ext": "webm",
+        "acodec": "opus",
+        "vcodec": "none",
+        "extractor": "youtube",
+        "extractor_key": "Youtube",
+        "webpage_url": "https://www.youtube.com/watch?v=abcdefghijk",
+        "formats": [
+            {
+                "format_id": "251",
+                "url": f"{media_url}/audio.webm",
+                "ext": "webm",
+                "acodec": "opus",
+                "vcodec": "none",
+            }
+        ],
+    }
+
+
+def test_transcode_gets_full_info(media_server, download_dir, monkeypatch):
+    # ffmpeg isn't needed to check what the extractor is handed
+    seen = []
+
+    def fake_extract(self, information):
+        seen.append(information)
+        return [], information
+
+    monkeypatch.setattr(FFmpegExtractAudioPP, "run", fake_extract)
+
+    format_opts = main.AUDIO_FORMATS["mp3"]
+    info = stub_info(media_server)
+    info = main.fetch_source(info["webpage_url"], "mp3", format_opts, info)
+    # stand in for a fixup the download stage queued and already ran
+    info["requested_downloads"][0]["__postprocessors"] = [object()]
+
+    result = main.transcode("mp3", format_opts, info)
+
+    (information,) = seen
+    assert information["ext"] == "webm"
+    assert information["title"] == "Test"
+    assert "__postprocessors" not in information
+    assert result["filepath"] == info["requested_downloads"][0]["filepath"]
+
+
+def test_reused_download_keeps_file_alive(media_server, download_dir, monkeypatch):
+    def fake_extract(self, information):
+        # stand in for ffmpeg: write the converted file next to the source
+        source = information["filepath"]
+        converted = os.path.splitext(source)[0] + ".mp3"
+        with open(converted, "wb") as f:
+            f.write(b"mp3")
+        information["filepath"] = converted
+        return [source], information
+
+    monkeypatch.setattr(FFmpegExtractAudioPP, "run", fake_extract)
+    monkeypatch.setattr(
+        main, "TEMP_DOWNLOADS", main.DownloadCache(maxsize=10, ttl=60, timer=time.time)
+    )
+    monkeypatch.setattr(main, "ACCEL_REDIRECT_PREFIX", "/internal")
+    info = stub_info(media_server)
+
+    async def scenario():
+        fresh, fetched = await main.download_audio(info["webpage_url"], "mp3", info)
+        first = main.register_download(fresh, "mp3", fetched)
+        reused, _ = await main.download_audio(info["webpage_url"], "mp3", info)
+        main.register_download(reused, "mp3", info)
+
+        # the first link expiring must not delete the file the second still uses
+        del main.TEMP_DOWNLOADS[first.download_id]
+        await main.cleanup_expired_downloads()
+        return fresh, reused
+
+    fresh, reused = asyncio.run(scenario())
+
+    assert fresh == reused == main.output_path(info["id"], "mp3", main.AUDIO_FORMATS["mp3"])
+    assert reused.exists()
+    assert main.accel_redirect_path(reused) == "/internal/downloads/abcdefghijk-mp3.mp3"
+
+
+def test_failed_transcode_is_not_reused(media_server, download_dir, monkeypatch):
+    def truncating_extract(self, information):
+        # ffmpeg dies after writing part of the final file
+        converted = os.path.splitext(information["filepath"])[0] + ".mp3"
+        with open(converted, "wb") as f:
+            f.write(b"trunc")
+        raise PostProcessingError("audio conversion failed")
+
+    def fake_extract(self, information):
+        source = information["filepath"]
+        converted = os.path.splitext(source)[0] + ".mp3"
+        with open(converted, "wb") as f:
+            f.write(b"mp3")
+        information["filepath"] = converted
+        return [source], information
+
+    info = stub_info(media_server)
+    target = main.output_path(info["id"], "mp3", main.AUDIO_FORMATS["mp3"])
+
+    monkeypatch.setattr(FFmpegExtractAudioPP, "run", truncating_extract)
+    with pytest.raises(HTTPException):
+        asyncio.run(main.download_audio(info["webpage_url"], "mp3", info))
+    # neither the partial output nor the raw source is left behind for good
+    assert list(download_dir.iterdir()) == []
+
+    # a transcode killed outright can't clean up; its leftover isn't reused
+    target.write_bytes(b"trunc")
+    monkeypatch.setattr(FFmpegExtractAudioPP, "run", fake_extract)
+    filepath, _ = asyncio.run(main.download_audio(info["webpage_url"], "mp3", info))
+
+    assert filepath == target
+    assert filepath.read_bytes() == b"mp3"
+
+
+def test_coalesced_download_survives_a_cancelled_caller():
+    calls = []
+
+    async def scenario():
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def download(result):
+            calls.append(result)
+            started.set()
+            await release.wait()
+            return result
+
+        key = ("abcdefghijk", "mp3")
+        callers = [
+            asyncio.create_task(main.run_coalesced(key, download, "done")) for _ in range(3)
+        ]
+        await started.wait()
+        callers[0].cancel()
+        # a request arriving after the cancel joins the running download
+        callers.append(asyncio.create_task(main.run_coalesced(key, download, "done")))
+        await asyncio.sleep(0)
+        release.set()
+
+        results = await asyncio.gather(*callers, return_exceptions=True)
+        return results, dict(main.INFLIGHT)
+
+    results, inflight = asyncio.run(scenario())
+
+    assert isinstance(results[0], asyncio.CancelledError)
+    assert results[1:] == ["done", "done", "done"]
+    assert calls == ["done"]
+    assert inflight == {}